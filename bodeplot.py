@@ -72,7 +72,7 @@ import time
 import sys
 import argparse
 import math
-import csv
+import concurrent.futures
 
 # Declare Global Constants
 channelHighGain = 10 # Channel Gain, 10 is the highest gain, used here for more precise measurements
@@ -81,7 +81,11 @@ lowerAmplitude = 0.1 # Usa a 0.1 V peak to peak sine wave with the function gene
 lowAmplitude = 1 # Use a 1 V peak to peak sine wave with the function generator when the filter gain is more than 1/200
 highAmplitude = 10 #Use a 10 V peak to peak sine wave with the function generator when the filter gain is less than 1/200
 samplerates = (20, 32, 50, 64, 100, 128, 200, 500, 1000, 2000, 4000, 8000, 10000) # Valid samplerates in kilo samples per second
-blocks = 20 # Number of 1024 samples to capture
+blocks = 20 # Maximum number of 1024 samples to capture
+minBlocks = 2 # Minimum number of 1024 samples to capture
+cycles = 32 # Number of waveform periods to capture, fewer blocks are used at high frequencies
+twiddleBlock = 128 # Block size in samples when building the DFT cosine and sine by angle addition
+twoPi = 2.0*math.pi # Radians in one period
 
 # construct the argument parser and parse the arguments
 ap = argparse.ArgumentParser(
@@ -94,17 +98,19 @@ ap.add_argument( "--fstep", type = float, default = 1.1, help="Step frequency mu
 ap.add_argument( "--filename", default = "bodeplot.csv", help="Filename to save the bodeplot information. Default bodeplot.csv." )
 
 options = ap.parse_args()
+if options.fstart <= 0:
+    ap.error( "--fstart must be greater than 0 Hz." )
+if options.fstop <= 0:
+    ap.error( "--fstop must be greater than 0 Hz." )
+if options.fstep <= 1:
+    ap.error( "--fstep must be greater than 1." )
 
 # Setup Function Generator
 ft = feeltech.FeelTech(options.port)
 c = ft.channels()
  
-# Create place to hold data from the Oscilloscope capture
-data_points = blocks * 1024
-
-# Skip the first 2K samples due to unstable transfer from oscilloscope
+# Skip the first 2K samples of each capture due to unstable transfer from oscilloscope
 skip = 2 * 1024
-data_points += skip
 
 # Setup Oscilloscope
 scope = Oscilloscope()
@@ -124,28 +130,31 @@ scope.set_ch1_ac_dc(scope.DC) # DC coupling
 scope.set_ch2_voltage_range(channelHighGain) # Highest Gain
 scope.set_ch2_ac_dc(scope.DC) # DC coupling
 
-# Start frequency
-freq = options.fstart
-
-# Save bodeplot data
-data = []
+# Read the scope calibration values once, they do not change during the sweep
+calibration = scope.get_calibration_values()
 
-# Default Gain mode
-gainMode = 1
+# Sorted array of the valid samplerates for looking up the sample rate to use
+samplerates_array = np.array(samplerates)
 
-while(freq < options.fstop):
+# Program the function generator and scope for a frequency and gainMode,
+# then capture and scale the waveforms on channel 1 and channel 2. Runs on
+# a background thread so the next capture overlaps processing of the last.
+def capture(freq, gainMode):
     # Calculate the sample rate to use for the scope
+    # (the lowest valid sample rate at or above the target, or the highest one)
     samplerate_target = 2*freq
-    samplerate = samplerates[0]
-    for sr in samplerates:
-        if samplerate < samplerate_target:
-            samplerate = sr
+    samplerate = int(samplerates_array[min(np.searchsorted(samplerates_array, samplerate_target), len(samplerates_array)-1)])
     # Calculate and set the sample rate ID from real sample rate value
     if samplerate < 1e3:
         sample_id = int( round( 100 + samplerate / 10 ) ) # 20k..500k -> 102..150
     else:
         sample_id = int( round( samplerate / 1e3 ) ) # 1000k -> 1
     scope.set_sample_rate(sample_id)
+    fs = samplerate*1000.0 # Sample rate in samples per second
+
+    # Capture enough 1024 sample blocks to hold cycles periods of the waveform
+    capture_blocks = max(minBlocks, min(blocks, math.ceil(cycles*fs/freq/1024)))
+    data_points = capture_blocks*1024
 
     # Set the function generator waveform
     if gainMode == 0:
@@ -165,126 +174,146 @@ while(freq < options.fstop):
         scope.set_ch2_voltage_range(channelHighGain) # Highest Gain
         c[0].frequency(freq).waveform(feeltech.SINE).offset(0).amplitude(lowerAmplitude) # 0.1 Vpp
 
-
-    # Read and apply scope calibration values
-    calibration = scope.get_calibration_values()
-    
     # Wait a 10th of a second for things to settle out with the function generator and scope
     time.sleep(0.1)
 
     # Capture the waveforms on channel 1 and channel 2
-    ch1_data, ch2_data = scope.read_data(data_points)#,raw=True)#timeout=1)
+    ch1_data, ch2_data = scope.read_data(data_points + skip)#,raw=True)#timeout=1)
+    ch1_data = ch1_data[skip:]
+    ch2_data = ch2_data[skip:]
     if gainMode == 0:
-        voltage_data1 = scope.scale_read_data(ch1_data[skip:], channelHighGain, channel=1 )
-        voltage_data2 = scope.scale_read_data(ch2_data[skip:], channelLowGain, channel=2 )
+        voltage_data1 = scope.scale_read_data(ch1_data, channelHighGain, channel=1 )
+        voltage_data2 = scope.scale_read_data(ch2_data, channelLowGain, channel=2 )
     elif gainMode == 1:
-        voltage_data1 = scope.scale_read_data(ch1_data[skip:], channelHighGain, channel=1 )
-        voltage_data2 = scope.scale_read_data(ch2_data[skip:], channelHighGain, channel=2 )
-    else:
-        voltage_data1 = scope.scale_read_data(ch1_data[skip:], channelLowGain, channel=1 )    
-        voltage_data2 = scope.scale_read_data(ch2_data[skip:], channelHighGain, channel=2 )
-
-    timing_data, rate_label = scope.convert_sampling_rate_to_measurement_times(data_points-skip, sample_id)
-
-    # Calculate the RMS value and DC value
-    rms1 = 0
-    dc1 = 0
-    n1 = 0
-    for v in voltage_data1:
-        rms1 = rms1 + v*v
-        dc1 = dc1 + v
-        n1 = n1 + 1
-    rms1 = math.sqrt(rms1/n1) - dc1/n1
-
-    # Calculate the RMS value and DC value
-    rms2 = 0
-    dc2 = 0
-    n2 = 0
-    for v in voltage_data2:
-        rms2 =rms2 + v*v
-        dc2 = dc2 + v
-        n2 = n2 + 1
-    rms2 = math.sqrt(rms2/n2) - dc2/n2
-
-    # Look at the RMS value of channel 1 to determine if the gainMode is correct.
-    # If not, change the gainMode and try again
-    if gainMode == 0 and rms1 > 0.2:
-        gainMode = 1
-    elif gainMode == 1 and rms1 < 0.015:
-        gainMode = 0
-    elif gainMode == 1 and rms1 > 0.4:
-        gainMode = 2
-    elif gainMode == 2 and rms1 < 0.15:
-        gainMode = 1
-    elif gainMode == 2 and rms1 > 4:
-        gainMode = 3
-    elif gainMode == 3 and rms1 < 0.15:
-        gainMode = 2
-    # The gainMode was fine, continue processing the data and save it, then move on to the next frequency
+        voltage_data1 = scope.scale_read_data(ch1_data, channelHighGain, channel=1 )
+        voltage_data2 = scope.scale_read_data(ch2_data, channelHighGain, channel=2 )
     else:
-        # Compute the FFT for Channel 1
-        fft_values = np.fft.fft(voltage_data1)
-        N = len(voltage_data1)  # Number of samples
-        frequencies = np.fft.fftfreq(N, 1/samplerate/1000)  # Frequency bins
-
-        # Compute the magnitude and phase of the FFT
-        fft_magnitude = np.abs(fft_values)[:N // 2] / N  # Magnitude (positive frequencies)
-        fft_phase = np.angle(fft_values)[:N // 2]  # Phase (positive frequencies)
-        frequencies = frequencies[:N // 2]  # Positive frequency range
-
-        # Find the index of the fundamental frequency (largest magnitude component)
-        fundamental_index = np.argmax(fft_magnitude[1:]) + 1  # Skip the DC component (index 0)
-
-        # Fundamental frequency, magnitude, and phase
-        fundamental_frequency = frequencies[fundamental_index]
-        fundamental_magnitude = fft_magnitude[fundamental_index]
-        fundamental_phase = fft_phase[fundamental_index]
-
-        # Compute the FFT for Channel 2
-        fft_values = np.fft.fft(voltage_data2)
-        N = len(voltage_data2)  # Number of samples
-        frequencies = np.fft.fftfreq(N, 1/samplerate/1000)  # Frequency bins
-
-        # Compute the magnitude and phase of the FFT
-        fft_magnitude = np.abs(fft_values)[:N // 2] / N  # Magnitude (positive frequencies)
-        fft_phase = np.angle(fft_values)[:N // 2]  # Phase (positive frequencies)
-        frequencies = frequencies[:N // 2]  # Positive frequency range
-
-        # Find the index of the fundamental frequency (largest magnitude component)
-        fundamental_index = np.argmax(fft_magnitude[1:]) + 1  # Skip the DC component (index 0)
-
-        # Fundamental frequency, magnitude, and phase
-        fundamental_frequency2 = frequencies[fundamental_index]
-        fundamental_magnitude2 = fft_magnitude[fundamental_index]
-        fundamental_phase2 = fft_phase[fundamental_index]
-    
-        # Calculate the phase difference
-        deltaphase = fundamental_phase - fundamental_phase2
-        if deltaphase > math.pi:
-            deltaphase = deltaphase - 2*math.pi
-        if deltaphase < -math.pi:
-            deltaphase = deltaphase + 2*math.pi
-
-        # Save the bode plot data
-        data.append([freq, rms1, rms2, rms1/rms2, deltaphase])    
+        voltage_data1 = scope.scale_read_data(ch1_data, channelLowGain, channel=1 )    
+        voltage_data2 = scope.scale_read_data(ch2_data, channelHighGain, channel=2 )
+
+    # Convert the scaled waveforms to one array, a row per channel, and reuse it
+    # for the RMS and DFT
+    v = np.array((voltage_data1, voltage_data2), dtype=np.float32)
+
+    timing_data, rate_label = scope.convert_sampling_rate_to_measurement_times(data_points, sample_id)
+
+    # Sample period in seconds
+    dt = 1.0/fs
+
+    return dt, v
+
+# Start frequency
+freq = options.fstart
+
+# Save bodeplot data, one row per frequency step (plus one spare for rounding)
+steps = max(0, math.ceil(math.log(options.fstop/options.fstart)/math.log(options.fstep))) + 1
+data = np.empty((steps, 5))
+step = 0
+
+# Default Gain mode
+gainMode = 1
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    # Start the first capture
+    if freq < options.fstop:
+        pending = executor.submit(capture, freq, gainMode)
+
+    while(freq < options.fstop):
+        # Wait for the capture at this frequency to finish
+        dt, v = pending.result()
+        v1, v2 = v
+
+        # Calculate the RMS value and DC value of channel 1, this alone decides
+        # if the point has to be retried at a different gainMode. Accumulate in
+        # float64, the RMS subtracts two nearly equal values when DC is large
+        sum1 = float(v1.sum(dtype=np.float64))
+        sqsum1 = float(np.einsum('i,i->', v1, v1, dtype=np.float64))
+        n1 = v1.size
+        rms1 = math.sqrt(sqsum1/n1) - sum1/n1
+
+        # Look at the RMS value of channel 1 to determine if the gainMode is correct.
+        # If not, change the gainMode and try again
+        accepted = False
+        nextFreq = freq
+        if gainMode == 0 and rms1 > 0.2:
+            gainMode = 1
+        elif gainMode == 1 and rms1 < 0.015:
+            gainMode = 0
+        elif gainMode == 1 and rms1 > 0.4:
+            gainMode = 2
+        elif gainMode == 2 and rms1 < 0.15:
+            gainMode = 1
+        elif gainMode == 2 and rms1 > 4:
+            gainMode = 3
+        elif gainMode == 3 and rms1 < 0.15:
+            gainMode = 2
+        # The gainMode was fine, move on to the next frequency
+        else:
+            accepted = True
+            nextFreq = freq*options.fstep
+
+        # Start the next capture while this one is processed
+        if nextFreq < options.fstop:
+            pending = executor.submit(capture, nextFreq, gainMode)
+
+        # The gainMode was fine, continue processing the data and save it
+        if accepted:
+            # Calculate the RMS value and DC value
+            sum2 = float(v2.sum(dtype=np.float64))
+            sqsum2 = float(np.einsum('i,i->', v2, v2, dtype=np.float64))
+            n2 = v2.size
+            rms2 = math.sqrt(sqsum2/n2) - sum2/n2
+
+            # Evaluate a single bin DFT at the drive frequency rather than a full FFT.
+            # The drive frequency is known, so there is no need to search for the
+            # fundamental. The samples are real, so correlate against the cosine
+            # and sine separately instead of promoting the data to complex.
+            N = v.shape[1]  # Number of samples
+            omega = twoPi*freq*dt  # Drive frequency phase step per sample
+
+            # Build the cosine and sine by angle addition, exp(j*omega*(k*B + i)) =
+            # exp(j*omega*k*B) * exp(j*omega*i), so trig is only evaluated for one
+            # block of B samples and once per block instead of at every sample
+            rows = -(-N // twiddleBlock)
+            w = np.outer(np.exp(1j*omega*twiddleBlock*np.arange(rows)), np.exp(1j*omega*np.arange(twiddleBlock))).ravel()[:N]
+            basis = np.empty((2, N), dtype=np.float32)
+            basis[0] = w.real
+            basis[1] = w.imag
+
+            # Correlate both channels against the cosine and sine in a single
+            # matrix product, X[channel] = (real, -imaginary), as Python floats for
+            # the scalar math below
+            X = (v @ basis.T).tolist()
+
+            # Fundamental phase for Channel 1 and Channel 2, the gain comes from the
+            # RMS values so the fundamental magnitude is not needed
+            fundamental_phase = math.atan2(-X[0][1], X[0][0])
+            fundamental_phase2 = math.atan2(-X[1][1], X[1][0])
+        
+            # Calculate the phase difference, wrapped to -pi..pi
+            deltaphase = math.remainder(fundamental_phase - fundamental_phase2, twoPi)
+
+            # Save the bode plot data
+            data[step] = (freq, rms1, rms2, rms1/rms2, deltaphase)
+            step += 1
 
         # Next frequency
-        freq = freq*options.fstep
+        freq = nextFreq
 
 # Close the scope
 scope.close_handle()
 
+# Drop the unused rows
+data = data[:step]
+
 # Save the bodeplot data as a CSV file
-with open(options.filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(["Frequency", "Channel 1 RMS Magnitude", "Channel 2 RMS Magnitude", "Gain (Ch1/Ch2)", "Phase Difference"])
-    writer.writerows(data)
+np.savetxt(options.filename, data, fmt='%s', delimiter=',', comments='',
+           header="Frequency,Channel 1 RMS Magnitude,Channel 2 RMS Magnitude,Gain (Ch1/Ch2),Phase Difference")
 
 # Extract the bodeplot data for plotting
-data_array = np.array(data)
-frequencies = data_array[:,0]
-gains = data_array[:,3]
-phase = data_array[:,4]*180/math.pi
+frequencies = data[:,0]
+gains = data[:,3]
+phase = data[:,4]*180/math.pi
 
 # Create a figure and two subplots
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 7))  # 2 rows, 1 column